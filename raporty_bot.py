@@ -13,12 +13,18 @@
 
 import os
 import re
+import asyncio
 import json
 import logging
 import shutil
+import threading
+import time
+import weakref
 import calendar as cal
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, date, timedelta
+from io import BytesIO
 from typing import Dict, List, Optional, Tuple
 
 from dotenv import load_dotenv
@@ -32,6 +38,33 @@ try:
 except ModuleNotFoundError:
     ClientContext = ClientCredential = None  # brak biblioteki → upload pomijamy
 
+# ───────────── xlsxwriter (opcjonalny, szybszy zapis eksportów) ─────────────
+try:
+    import xlsxwriter
+except ModuleNotFoundError:
+    xlsxwriter = None  # brak biblioteki → eksport przez openpyxl write-only
+
+# ───────────── orjson (opcjonalny, szybszy JSON dla WAL/mapowań/presetów) ─────────────
+try:
+    import orjson
+except ModuleNotFoundError:
+    orjson = None  # brak biblioteki → stdlib json
+
+def _json_dumps(obj) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+def _json_loads(data: bytes):
+    return orjson.loads(data) if orjson else json.loads(data)
+
+# ───────────── h2 (opcjonalny, HTTP/2 do Bot API) ─────────────
+try:
+    import h2  # noqa: F401  – httpx używa go sam, sprawdzamy tylko obecność
+    HTTP_VERSION = "2"
+except ModuleNotFoundError:
+    HTTP_VERSION = "1.1"  # brak biblioteki → zwykłe HTTP/1.1
+
 # ───────────── Telegram ─────────────
 from telegram import (
     Update,
@@ -42,11 +75,15 @@ from telegram import (
 from telegram.ext import (
     ApplicationBuilder,
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
+    TypeHandler,
     CallbackQueryHandler,
     MessageHandler,
     ContextTypes,
     ConversationHandler,
+    PersistenceInput,
+    PicklePersistence,
     filters,
 )
 from telegram.error import BadRequest
@@ -68,6 +105,14 @@ os.makedirs(DATA_DIR, exist_ok=True)
 BACKUP_DIR = os.path.join(DATA_DIR, "backups")
 os.makedirs(BACKUP_DIR, exist_ok=True)
 BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "20"))
+FLUSH_DELAY = float(os.getenv("FLUSH_DELAY", "2"))  # s bezczynności przed zapisem reports.xlsx
+FLUSH_MAX_AGE = float(os.getenv("FLUSH_MAX_AGE", "300"))  # s – najpóźniej po tylu sekundach zmian xlsx jest zapisany
+UPLOAD_DELAY = float(os.getenv("UPLOAD_DELAY", "30"))  # s bez nowych zapisów xlsx przed wysyłką na SharePoint
+UPLOAD_RETRIES = 3  # ile razy ponawiamy nieudany upload na SharePoint
+UPLOAD_CHUNK = 4 * 1024 * 1024  # B – powyżej tego rozmiaru upload na SharePoint idzie kawałkami
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "3600"))  # s bezczynności, po których czyścimy user_data
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))  # ilu użytkowników obsługujemy równolegle
+TG_POOL_SIZE = int(os.getenv("TG_POOL_SIZE", str(max(256, CONCURRENT_UPDATES * 4))))  # połączenia HTTP do Bot API (edit+delete+answer równolegle)
 
 # opcjonalne SharePoint
 SHAREPOINT_SITE = os.getenv("SHAREPOINT_SITE")
@@ -79,8 +124,11 @@ EXCEL_FILE = os.path.join(DATA_DIR, "reports.xlsx")
 MAPPING_FILE = os.path.join(DATA_DIR, "report_msgs.json")
 PRESETS_FILE = os.path.join(DATA_DIR, "presets.json")
 LOCK_FILE = os.path.join(DATA_DIR, "reports.lock")
+PRESETS_LOCK_FILE = os.path.join(DATA_DIR, "presets.lock")
+WAL_FILE = os.path.join(DATA_DIR, "reports.wal")  # dziennik zapisów (JSONL) – odtwarzany po awarii
+STATE_FILE = os.path.join(DATA_DIR, "bot_state.pickle")  # user_data (panel, sticky_id) – przeżywa restart
 
-ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit()}
+ADMIN_IDS = frozenset(int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip().isdigit())
 
 # ──────────────────── stałe excela ────────────────────
 HEADERS = [
@@ -94,266 +142,504 @@ HEADERS = [
     "Uwagi",
 ]
 COLS = {name: i + 1 for i, name in enumerate(HEADERS)}  # 1-based
+FIELD_COLS = {
+    "place": "Miejsce",
+    "start": "Start",
+    "end": "Koniec",
+    "tasks": "Zadania",
+    "notes": "Uwagi",
+}
+FIELD_COL_IDX = {f: COLS[h] for f, h in FIELD_COLS.items()}  # pole → numer kolumny (1-based), liczone raz
 
 # ──────────────────── stany ────────────────────
 DATE_PICK = 10
 OVERLAP_DECIDE = 11
 
 # ──────────────────── helpers: excel/lock/backup ────────────────────
+# Workbook trzymany jest w pamięci (przeładowanie tylko gdy plik zmieni się z zewnątrz).
+# Zmiany trafiają od razu do WAL i do pamięci, a xlsx zapisywany jest z opóźnieniem
+# (FLUSH_DELAY s bezczynności) – seria zmian kończy się jednym zapisem pliku.
+_WB_LOCK = threading.RLock()  # handlery działają w wątkach roboczych – Workbook nie jest thread-safe
+_wb_cache: Optional[Tuple[int, Workbook]] = None  # (mtime_ns pliku, workbook)
+_wb_dirty = False  # pamięć nowsza niż plik (zmiany są już w WAL)
+_flush_timer: Optional[threading.Timer] = None
+_dirty_since = 0.0  # monotonic – od kiedy pamięć jest nowsza niż plik
+
 def _atomic_save_wb(wb: Workbook, path: str) -> None:
     fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
     os.close(fd)
     wb.save(tmp_path)
     os.replace(tmp_path, path)
 
+def _atomic_write_bytes(path: str, data: bytes) -> None:
+    # małe pliki JSON: zapis do tmp + os.replace – czytelnik nigdy nie trafi na ucięty plik
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
 def _with_lock(fn, *args, **kwargs):
-    with portalocker.Lock(LOCK_FILE, timeout=30):
+    # odczyty i zapisy po kolei: workbook w pamięci nie jest bezpieczny przy równoległym dostępie.
+    # Najpierw blokada w procesie, potem plikowa – wątek czekający na _WB_LOCK nie trzyma flocka
+    with _WB_LOCK, portalocker.Lock(LOCK_FILE, timeout=30, flags=portalocker.LockFlags.EXCLUSIVE | portalocker.LockFlags.NON_BLOCKING):
         return fn(*args, **kwargs)
 
+# nazwy kopii (rosnąco) trzymane w pamięci – listdir tylko przy pierwszej kopii po starcie
+_BACKUP_LOCK = threading.Lock()
+_backup_names: Optional[List[str]] = None
+
 def _backup_file():
-    if not os.path.exists(EXCEL_FILE):
-        return
+    # wołane tylko po udanym flush_now – plik na pewno istnieje, bez dodatkowego stat()
+    global _backup_names
     ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    dst = os.path.join(BACKUP_DIR, f"reports_{ts}.xlsx")
-    try:
-        shutil.copy2(EXCEL_FILE, dst)
-    except Exception as e:
-        logging.warning("Backup failed: %s", e)
-    files = sorted([f for f in os.listdir(BACKUP_DIR) if f.startswith("reports_") and f.endswith(".xlsx")])
-    if len(files) > BACKUP_KEEP:
-        for old in files[: len(files) - BACKUP_KEEP]:
+    name = f"reports_{ts}.xlsx"
+    with _BACKUP_LOCK:
+        dst = os.path.join(BACKUP_DIR, name)
+        try:
+            # reports.xlsx zapisujemy zawsze przez os.replace (nowy i-węzeł), więc twarde dowiązanie
+            # jest pełną migawką bez kopiowania bajtów; kopia tylko gdy link się nie da (inny FS, exFAT)
+            try:
+                os.link(EXCEL_FILE, dst)
+            except OSError:
+                shutil.copy2(EXCEL_FILE, dst)
+        except Exception as e:
+            logging.warning("Backup failed: %s", e)
+            return
+        if _backup_names is None:
+            _backup_names = sorted(f for f in os.listdir(BACKUP_DIR) if f.startswith("reports_") and f.endswith(".xlsx"))
+        elif not _backup_names or _backup_names[-1] != name:
+            _backup_names.append(name)
+        while len(_backup_names) > BACKUP_KEEP:
+            old = _backup_names.pop(0)
             try:
                 os.remove(os.path.join(BACKUP_DIR, old))
             except Exception:
                 pass
 
 def open_wb() -> Workbook:
-    if os.path.exists(EXCEL_FILE):
-        return load_workbook(EXCEL_FILE)
-    return Workbook()
+    # jedyne wczytanie z dysku (potem workbook żyje w pamięci); read_only odpada, bo edytujemy w miejscu,
+    # ale linków zewnętrznych nie używamy – nie ma po co ich parsować
+    try:
+        return load_workbook(EXCEL_FILE, keep_links=False)
+    except FileNotFoundError:
+        return Workbook()
+
+def _get_wb() -> Workbook:
+    # wołać pod _with_lock
+    global _wb_cache, _wb_dirty
+    if _wb_cache and _wb_dirty:
+        return _wb_cache[1]
+    try:
+        mtime = os.stat(EXCEL_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = 0
+    if _wb_cache and _wb_cache[0] == mtime:
+        return _wb_cache[1]
+    wb = open_wb()
+    records, skipped = _wal_read()
+    applied = 0
+    for rec in records:
+        # wpis, którego nie da się nałożyć, pomijamy jak uszkodzoną linię – inaczej blokowałby start bota
+        try:
+            _wal_apply(wb, rec)
+            applied += 1
+        except Exception as e:
+            skipped += 1
+            logging.warning("WAL: pominięto wpis %r: %s", rec.get("rid") if isinstance(rec, dict) else rec, e)
+    _wb_cache = (mtime, wb)
+    if applied:
+        logging.info("WAL: odtworzono %d wpisów", applied)
+        _mark_dirty()  # flush zapisze xlsx i obetnie WAL razem z ewentualnymi uszkodzonymi liniami
+    elif skipped:
+        _wal_truncate()  # same uszkodzone linie – nie ma czego odtwarzać, a nie mogą zostać w pliku
+    return wb
+
+def _mark_dirty() -> None:
+    # debounce: każda kolejna zmiana w ciągu FLUSH_DELAY przesuwa zapis xlsx,
+    # ale nie dalej niż FLUSH_MAX_AGE od pierwszej niezapisanej zmiany (ciągły ruch też dochodzi do pliku)
+    global _wb_dirty, _flush_timer, _dirty_since
+    now = time.monotonic()
+    if not _wb_dirty:
+        _dirty_since = now
+    _wb_dirty = True
+    if _flush_timer:
+        _flush_timer.cancel()
+    delay = min(FLUSH_DELAY, max(0.0, _dirty_since + FLUSH_MAX_AGE - now))
+    _flush_timer = threading.Timer(delay, flush_now)
+    _flush_timer.daemon = True
+    _flush_timer.start()
+
+def flush_now() -> None:
+    def _flush() -> bool:
+        global _wb_cache, _wb_dirty
+        if not (_wb_cache and _wb_dirty):
+            return False
+        wb = _wb_cache[1]
+        _atomic_save_wb(wb, EXCEL_FILE)
+        _wal_truncate()
+        _wb_cache = (os.stat(EXCEL_FILE).st_mtime_ns, wb)
+        _wb_dirty = False
+        return True
+    if _with_lock(_flush):
+        # kopia zapisanego pliku już bez blokady – os.replace jest atomowy, więc czytamy pełną wersję
+        _backup_file()
+        _schedule_upload()
 
 def month_key_from_date(date_str: str) -> str:
-    d = datetime.strptime(date_str, "%d.%m.%Y")
-    return f"{d.year:04d}-{d.month:02d}"
+    # "dd.mm.YYYY" → "YYYY-MM"; split zamiast strptime (wołane przy każdej operacji na danych)
+    _, m, y = date_str.split(".")
+    return f"{int(y):04d}-{int(m):02d}"
+
+def _sheets_by_name(wb: Workbook) -> Dict[str, Worksheet]:
+    # słownik tytuł → arkusz budowany raz na workbook (zamiast skanów wb.sheetnames / wb[...]);
+    # przy dodaniu arkusza tylko go dopisujemy – pozycje arkuszy nie mają znaczenia
+    by_name = getattr(wb, "_sheets_by_name", None)
+    if by_name is None:
+        by_name = {ws.title: ws for ws in wb.worksheets}
+        wb._sheets_by_name = by_name
+    return by_name
 
 def ensure_month_sheet(wb: Workbook, month_key: str) -> Worksheet:
-    ws: Optional[Worksheet] = wb[month_key] if month_key in wb.sheetnames else None
-    if ws is None:
-        ws = wb.create_sheet(title=month_key, index=0)
-        ws.append(HEADERS)
-        if "Sheet" in wb.sheetnames and wb["Sheet"].max_row == 1 and wb["Sheet"].max_column == 1:
-            wb.remove(wb["Sheet"])
-    else:
-        idx = wb.sheetnames.index(month_key)
-        if idx != 0:
-            wb.move_sheet(ws, offset=-idx)
+    # nowy miesiąc trafia na początek; istniejących arkuszy nie przestawiamy (każda edycja starszego
+    # miesiąca przesuwała go na przód i przebudowywała indeks arkuszy)
+    by_name = _sheets_by_name(wb)
+    ws = by_name.get(month_key)
+    if ws is not None:
+        return ws
+    ws = wb.create_sheet(title=month_key, index=0)
+    ws.append(HEADERS)
+    by_name[month_key] = ws
+    default = by_name.get("Sheet")
+    if default is not None and default.max_row == 1 and default.max_column == 1:
+        wb.remove(default)
+        del by_name["Sheet"]
     return ws
 
 def get_month_sheet_if_exists(wb: Workbook, month_key: str) -> Optional[Worksheet]:
-    return wb[month_key] if month_key in wb.sheetnames else None
+    return _sheets_by_name(wb).get(month_key)
+
+@dataclass
+class RowIndex:
+    by_user: Dict[str, List[int]]  # "uid" → numery wierszy
+    by_day: Dict[str, List[int]]   # "uid_dd.mm.YYYY" → numery wierszy
+    by_rid: Dict[str, int]         # ID wiersza → numer wiersza
+    max_idx: Dict[str, int]        # "uid_dd.mm.YYYY" → najwyższy numer pozycji dnia
+
+def _index_row(idx: RowIndex, rid: str, row_no: int) -> None:
+    idx.by_user.setdefault(rid.split("_", 1)[0], []).append(row_no)
+    day, _, pos = rid.rpartition("_")
+    idx.by_day.setdefault(day, []).append(row_no)
+    idx.by_rid[rid] = row_no
+    if pos.isdigit() and int(pos) > idx.max_idx.get(day, 0):
+        idx.max_idx[day] = int(pos)
+
+def _row_index(ws: Worksheet) -> RowIndex:
+    # indeks wierszy arkusza; budowany raz na arkusz, aktualizowany przy dopisywaniu
+    idx = getattr(ws, "_row_index", None)
+    if idx is None:
+        idx = RowIndex({}, {}, {}, {})
+        for i, (cell_id,) in enumerate(ws.iter_rows(min_row=2, max_col=1, values_only=True), start=2):
+            if cell_id:
+                _index_row(idx, str(cell_id), i)
+        ws._row_index = idx
+    return idx
+
+def _row_values(ws: Worksheet, row_no: int) -> tuple:
+    # zawsze dokładnie len(HEADERS) wartości – można rozpakować krotkę
+    return next(ws.iter_rows(min_row=row_no, max_row=row_no, max_col=len(HEADERS), values_only=True))
 
 def report_exists(user_id: int, date_str: str) -> bool:
-    if not os.path.exists(EXCEL_FILE):
-        return False
     def _exists():
-        wb = load_workbook(EXCEL_FILE)
-        ws = get_month_sheet_if_exists(wb, month_key_from_date(date_str))
+        ws = get_month_sheet_if_exists(_get_wb(), month_key_from_date(date_str))
         if not ws:
             return False
-        prefix = f"{user_id}_{date_str}_"
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if (row and row[0]) and str(row[0]).startswith(prefix):
-                return True
-        return False
+        return bool(_row_index(ws).by_day.get(f"{user_id}_{date_str}"))
     return _with_lock(_exists)
 
-def save_report(entries: List[Dict[str, str]], user_id: int, date_str: str, name: str) -> None:
+# ──────────────────── write-ahead log ────────────────────
+# Każda zmiana trafia najpierw jako linia JSON do WAL_FILE (append + fsync), dopiero potem do xlsx.
+# Wpis: {"rid", "date", "name", "fields": {...}} – odtworzenie jest idempotentne (upsert po rid).
+def _wal_append(records: List[dict]) -> None:
+    data = b"".join(_json_dumps(r) + b"\n" for r in records)
+    with open(WAL_FILE, "a+b", buffering=0) as f:
+        # urwany ostatni wpis (awaria, ENOSPC) – zaczynamy od nowej linii, żeby nie skleić z nim nowego
+        end = f.seek(0, os.SEEK_END)
+        if end:
+            f.seek(end - 1)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+        os.fsync(f.fileno())
+
+def _wal_read() -> Tuple[List[dict], int]:
+    # (poprawne wpisy, liczba pominiętych uszkodzonych linii)
+    if not os.path.exists(WAL_FILE):
+        return [], 0
+    out: List[dict] = []
+    skipped = 0
+    with open(WAL_FILE, "rb") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                out.append(_json_loads(line))
+            except Exception:
+                skipped += 1
+                logging.warning("WAL: pominięto uszkodzony wpis")
+    return out, skipped
+
+def _wal_truncate() -> None:
+    if os.path.exists(WAL_FILE):
+        os.truncate(WAL_FILE, 0)
+
+def _find_row(ws: Worksheet, rid: str) -> Optional[int]:
+    return _row_index(ws).by_rid.get(rid)
+
+def _wal_apply(wb: Workbook, rec: dict) -> None:
+    ws = ensure_month_sheet(wb, month_key_from_date(rec["date"]))
+    fields = rec.get("fields", {})
+    row_no = _find_row(ws, rec["rid"])
+    if row_no is None:
+        ws.append([rec["rid"], rec["date"], rec.get("name", "")] + [fields.get(f, "") for f in FIELD_COLS])
+        # _current_row ustawia append; ws.max_row liczy max po wszystkich komórkach arkusza.
+        # Atrybut prywatny – zależy od openpyxl==3.1.5 z requirements (czytnik ustawia go na max_row)
+        _index_row(_row_index(ws), rec["rid"], ws._current_row)
+        return
+    for field, value in fields.items():
+        ws.cell(row=row_no, column=FIELD_COL_IDX[field], value=value)
+
+def replay_wal() -> None:
+    # WAL nakładany jest przy wczytaniu workbooka – tu tylko wymuszamy wczytanie i zapis
+    _with_lock(_get_wb)
+    flush_now()
+
+def save_report(entries: List[Dict[str, str]], user_id: int, date_str: str, name: str) -> List[Dict[str, str]]:
+    # zwraca wszystkie wpisy dnia po zapisie – wołający nie musi ich czytać ponownie
     def _save():
-        wb = open_wb()
+        wb = _get_wb()
         ws = ensure_month_sheet(wb, month_key_from_date(date_str))
-        prefix = f"{user_id}_{date_str}_"
-        existing_idxs: List[int] = []
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            rid = str(row[0]) if row and row[0] is not None else ""
-            if rid.startswith(prefix):
-                try:
-                    existing_idxs.append(int(rid.split("_")[-1]))
-                except Exception:
-                    pass
-        next_idx = (max(existing_idxs) + 1) if existing_idxs else 1
-        for off, e in enumerate(entries):
-            idx = next_idx + off
-            ws.append([
-                f"{user_id}_{date_str}_{idx}",
-                date_str,
-                name,
-                e.get("place", ""),
-                e.get("start", ""),
-                e.get("end", ""),
-                e.get("tasks", ""),
-                e.get("notes", ""),
-            ])
-        _backup_file()
-        _atomic_save_wb(wb, EXCEL_FILE)
-    _with_lock(_save)
-    _maybe_upload_sharepoint()
+        # kolejny numer pozycji dnia prosto z indeksu – bez czytania komórek
+        next_idx = _row_index(ws).max_idx.get(f"{user_id}_{date_str}", 0) + 1
+        records = [
+            {
+                "rid": f"{user_id}_{date_str}_{next_idx + off}",
+                "date": date_str,
+                "name": name,
+                "fields": {f: e.get(f, "") for f in FIELD_COLS},
+            }
+            for off, e in enumerate(entries)
+        ]
+        _wal_append(records)
+        for rec in records:
+            _wal_apply(wb, rec)
+        _mark_dirty()
+        return _day_entries(ws, user_id, date_str)
+    return _with_lock(_save)
+
+def _day_entries(ws: Optional[Worksheet], user_id: int, date_str: str) -> List[Dict[str, str]]:
+    # wołać pod _with_lock
+    if not ws:
+        return []
+    out: List[Dict[str, str]] = []
+    for i in _row_index(ws).by_day.get(f"{user_id}_{date_str}", []):
+        rid, d, nm, pl, st, en, tk, nt = _row_values(ws, i)
+        out.append({
+            "rid": str(rid),
+            "row": i,
+            "date": d,
+            "name": nm,
+            "place": pl or "",
+            "start": st or "",
+            "end": en or "",
+            "tasks": tk or "",
+            "notes": nt or "",
+        })
+    out.sort(key=lambda e: int(e["rid"].split("_")[-1]))
+    return out
 
 def read_entries_for_day(user_id: int, date_str: str) -> List[Dict[str, str]]:
-    if not os.path.exists(EXCEL_FILE):
-        return []
     def _read():
-        wb = load_workbook(EXCEL_FILE)
-        ws = get_month_sheet_if_exists(wb, month_key_from_date(date_str))
-        if not ws:
-            return []
-        prefix = f"{user_id}_{date_str}_"
-        out: List[Dict[str, str]] = []
-        for row in ws.iter_rows(min_row=2, values_only=False):
-            rid = str(row[0].value) if row and row[0] is not None else ""
-            if rid and rid.startswith(prefix):
-                out.append({
-                    "rid": rid,
-                    "row": row[0].row,
-                    "date": row[COLS["Data"] - 1].value,
-                    "name": row[COLS["Imię"] - 1].value,
-                    "place": row[COLS["Miejsce"] - 1].value or "",
-                    "start": row[COLS["Start"] - 1].value or "",
-                    "end": row[COLS["Koniec"] - 1].value or "",
-                    "tasks": row[COLS["Zadania"] - 1].value or "",
-                    "notes": row[COLS["Uwagi"] - 1].value or "",
-                })
-        out.sort(key=lambda e: int(e["rid"].split("_")[-1]))
-        return out
+        return _day_entries(get_month_sheet_if_exists(_get_wb(), month_key_from_date(date_str)), user_id, date_str)
     return _with_lock(_read)
 
 def read_entries_all_weeks(user_id: int) -> List[Dict[str, str]]:
-    if not os.path.exists(EXCEL_FILE):
-        return []
     def _read_all():
-        wb = load_workbook(EXCEL_FILE)
+        # tylko wiersze użytkownika (indeks) i tylko kolumny do "Koniec" – bez parsowania całych arkuszy
         out: List[Dict[str, str]] = []
-        for sheet_name in wb.sheetnames:
-            ws = wb[sheet_name]
-            if ws.max_row < 2:
-                continue
-            for row in ws.iter_rows(min_row=2, values_only=False):
-                rid = str(row[0].value) if row and row[0] is not None else ""
-                if rid and rid.startswith(f"{user_id}_"):
-                    out.append({
-                        "rid": rid,
-                        "date": row[COLS["Data"] - 1].value,
-                        "start": row[COLS["Start"] - 1].value or "",
-                        "end": row[COLS["Koniec"] - 1].value or "",
-                    })
+        for ws in _get_wb().worksheets:
+            for i in _row_index(ws).by_user.get(str(user_id), []):
+                rid, d, _, _, st, en = next(ws.iter_rows(min_row=i, max_row=i, max_col=COLS["Koniec"], values_only=True))
+                out.append({
+                    "rid": str(rid),
+                    "date": d,
+                    "start": st or "",
+                    "end": en or "",
+                })
         return out
     return _with_lock(_read_all)
 
 def update_report_field(user_id: int, date_str: str, rid: str, field: str, new_value: str) -> None:
     def _upd():
-        wb = load_workbook(EXCEL_FILE)
-        ws = ensure_month_sheet(wb, month_key_from_date(date_str))
-        col_name_map = {
-            "place": "Miejsce",
-            "start": "Start",
-            "end": "Koniec",
-            "tasks": "Zadania",
-            "notes": "Uwagi",
-        }
-        target_col = COLS[col_name_map[field]]
-        target_row = None
-        for row in ws.iter_rows(min_row=2, values_only=False):
-            if str(row[0].value) == rid:
-                target_row = row[0].row
-                break
-        if not target_row:
+        wb = _get_wb()
+        ws = get_month_sheet_if_exists(wb, month_key_from_date(date_str))
+        if not ws or not _find_row(ws, rid):
             raise RuntimeError("Nie znaleziono wiersza do edycji.")
-        ws.cell(row=target_row, column=target_col, value=new_value)
-        _backup_file()
-        _atomic_save_wb(wb, EXCEL_FILE)
+        if field not in FIELD_COL_IDX:
+            raise ValueError(f"Nieznane pole: {field}")  # przed zapisem do WAL – zły wpis nie trafia do dziennika
+        rec = {"rid": rid, "date": date_str, "fields": {field: new_value}}
+        _wal_append([rec])
+        _wal_apply(wb, rec)
+        _mark_dirty()
     _with_lock(_upd)
-    _maybe_upload_sharepoint()
 
-def _maybe_upload_sharepoint() -> None:
-    if all([ClientContext, SHAREPOINT_SITE, SHAREPOINT_DOC_LIB, SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET]):
+# upload na SharePoint w osobnym wątku, z własnym debounce – kolejne zapisy xlsx w ciągu
+# UPLOAD_DELAY s kończą się jednym uploadem, a zapis pliku nie czeka na sieć
+_UPLOAD_LOCK = threading.Lock()
+_upload_timer: Optional[threading.Timer] = None
+_UPLOAD_TIMER_LOCK = threading.Lock()  # podmiana timera – wołają ją flush_now i wątek ponowień
+
+def _sharepoint_enabled() -> bool:
+    return all([ClientContext, SHAREPOINT_SITE, SHAREPOINT_DOC_LIB, SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET])
+
+def _schedule_upload(delay: Optional[float] = None, attempt: int = 0) -> None:
+    global _upload_timer
+    if not _sharepoint_enabled():
+        return
+    with _UPLOAD_TIMER_LOCK:
+        if _upload_timer:
+            _upload_timer.cancel()
+        _upload_timer = threading.Timer(UPLOAD_DELAY if delay is None else delay, _maybe_upload_sharepoint, args=(attempt,))
+        _upload_timer.daemon = True
+        _upload_timer.start()
+
+def upload_pending() -> None:
+    # przy zamykaniu: zaległy upload wykonujemy od razu (timer jest daemonem i by przepadł)
+    global _upload_timer
+    with _UPLOAD_TIMER_LOCK:
+        timer, _upload_timer = _upload_timer, None
+    if timer and timer.is_alive():
+        timer.cancel()
+        # bez ponowień – timer-daemon po zamknięciu i tak by się nie wykonał
+        _maybe_upload_sharepoint(retry=False)
+
+def _maybe_upload_sharepoint(attempt: int = 0, retry: bool = True) -> None:
+    if not _sharepoint_enabled():
+        return
+    with _UPLOAD_LOCK:
         try:
             ctx = ClientContext(SHAREPOINT_SITE).with_credentials(
                 ClientCredential(SHAREPOINT_CLIENT_ID, SHAREPOINT_CLIENT_SECRET)
             )
             folder = ctx.web.get_folder_by_server_relative_url(SHAREPOINT_DOC_LIB)
-            with open(EXCEL_FILE, "rb") as f:
-                folder.upload_file(os.path.basename(EXCEL_FILE), f).execute_query()
+            if os.path.getsize(EXCEL_FILE) > UPLOAD_CHUNK:
+                # duży plik: sesja uploadu po kawałku – w pamięci najwyżej UPLOAD_CHUNK bajtów
+                folder.files.create_upload_session(EXCEL_FILE, UPLOAD_CHUNK).execute_query()
+            else:
+                with open(EXCEL_FILE, "rb") as f:
+                    folder.upload_file(os.path.basename(EXCEL_FILE), f).execute_query()
         except Exception as e:
-            logging.warning("SharePoint upload failed: %s", e)
+            if not retry or attempt >= UPLOAD_RETRIES:
+                logging.warning("SharePoint upload failed: %s", e)
+                return
+            # ponowienie z wykładniczym odstępem; nowy zapis i tak przestawi timer na świeży plik
+            logging.warning("SharePoint upload failed (próba %d), ponawiam: %s", attempt + 1, e)
+            _schedule_upload(UPLOAD_DELAY * 2 ** attempt, attempt + 1)
 
 # ──────────────────── presets (miejsca) ────────────────────
 def load_mapping() -> Dict[str, int]:
     if os.path.exists(MAPPING_FILE):
-        with open(MAPPING_FILE, "r", encoding="utf-8") as f:
+        with open(MAPPING_FILE, "rb") as f:
             try:
-                return json.load(f)
+                return _json_loads(f.read())
             except Exception:
                 return {}
     return {}
 
 def save_mapping(mapping: Dict[str, int]) -> None:
-    with open(MAPPING_FILE, "w", encoding="utf-8") as f:
-        json.dump(mapping, f)
+    _atomic_write_bytes(MAPPING_FILE, _json_dumps(mapping))
+
+# presets.json trzymany w pamięci – ponowne czytanie tylko gdy plik zmieni się z zewnątrz (mtime)
+_presets_cache: Optional[Tuple[int, Dict[str, Dict[str, List[str]]]]] = None
+_PRESETS_LOCK = threading.Lock()
+
+def _with_presets_lock(fn, *args, **kwargs):
+    # osobna blokada – zapis presetów nie czeka na zapis/flush reports.xlsx.
+    # Najpierw blokada w procesie, potem plikowa (jak w _with_lock) – wątki czekają na siebie, a nie odpytują flocka
+    with _PRESETS_LOCK, portalocker.Lock(PRESETS_LOCK_FILE, timeout=30, flags=portalocker.LockFlags.EXCLUSIVE | portalocker.LockFlags.NON_BLOCKING):
+        return fn(*args, **kwargs)
 
 def load_presets() -> Dict[str, Dict[str, List[str]]]:
-    if os.path.exists(PRESETS_FILE):
-        with open(PRESETS_FILE, "r", encoding="utf-8") as f:
+    global _presets_cache
+    try:
+        mtime = os.stat(PRESETS_FILE).st_mtime_ns
+    except FileNotFoundError:
+        mtime = 0
+    if _presets_cache and _presets_cache[0] == mtime:
+        return _presets_cache[1]
+    presets: Dict[str, Dict[str, List[str]]] = {}
+    if mtime:
+        with open(PRESETS_FILE, "rb") as f:
             try:
-                return json.load(f)
+                presets = _json_loads(f.read())
             except Exception:
-                return {}
-    return {}
+                presets = {}
+    _presets_cache = (mtime, presets)
+    return presets
 
 def save_presets(presets: Dict[str, Dict[str, List[str]]]) -> None:
-    with open(PRESETS_FILE, "w", encoding="utf-8") as f:
-        json.dump(presets, f, ensure_ascii=False)
+    global _presets_cache
+    _atomic_write_bytes(PRESETS_FILE, _json_dumps(presets))
+    _presets_cache = (os.stat(PRESETS_FILE).st_mtime_ns, presets)
 
 def remember_place(user_id: int, place: str) -> None:
     def _upd():
         presets = load_presets()
         key = str(user_id)
         user = presets.setdefault(key, {"places": []})
+        if user["places"][:1] == [place]:
+            return  # już na pierwszym miejscu – nie przepisujemy pliku
         if place in user["places"]:
             user["places"].remove(place)
         user["places"].insert(0, place)
         user["places"] = user["places"][:5]
         save_presets(presets)
-    _with_lock(_upd)
+    _with_presets_lock(_upd)
 
 def get_recent_places(user_id: int) -> List[str]:
     presets = load_presets()
     return presets.get(str(user_id), {}).get("places", [])
 
 # ──────────────────── helpers: time/tags/overlap ────────────────────
+@lru_cache(maxsize=2048)
 def time_to_minutes(t: str) -> int:
-    h, m = map(int, t.split(":"))
-    return h * 60 + m
+    # "HH:MM" ma najwyżej 1440 wartości – każdą parsujemy raz (sumy dnia, nakładanie się)
+    h, _, m = t.partition(":")
+    return int(h) * 60 + int(m)
 
 def minutes_to_hhmm(m: int) -> str:
     h = m // 60
     mm = m % 60
     return f"{h}h {mm:02d}m"
 
+TAG_RE = re.compile(r"#\w+")  # \w (unicode) obejmuje też polskie litery
+
 def extract_tags(text: str) -> List[str]:
-    return re.findall(r"#[\wąćęłńóśżźĄĆĘŁŃÓŚŻŹ]+", text or "")
+    return TAG_RE.findall(text or "")
 
-def intervals_overlap(a_start: str, a_end: str, b_start: str, b_end: str) -> bool:
-    return max(time_to_minutes(a_start), time_to_minutes(b_start)) < min(time_to_minutes(a_end), time_to_minutes(b_end))
+def _minutes_overlap(a_start: int, a_end: int, b_start: int, b_end: int) -> bool:
+    # jedyna definicja nakładania się przedziałów (w minutach)
+    return max(a_start, b_start) < min(a_end, b_end)
 
 def has_overlap(user_id: int, date_str: str, start: str, end: str, exclude_rid: Optional[str] = None, in_memory: Optional[List[Dict]] = None) -> Tuple[bool, List[Tuple[str, str]]]:
-    conflicts = []
-    for e in (in_memory or []):
-        if e.get("start") and e.get("end") and intervals_overlap(start, end, e["start"], e["end"]):
-            conflicts.append((e["start"], e["end"]))
-    for e in read_entries_for_day(user_id, date_str):
-        if exclude_rid and e["rid"] == exclude_rid:
-            continue
-        if e["start"] and e["end"] and intervals_overlap(start, end, e["start"], e["end"]):
-            conflicts.append((e["start"], e["end"]))
+    # nowy przedział liczony raz; wpisy dnia mogą na siebie zachodzić (ovl:ok), więc sprawdzamy każdy
+    s, e_ = time_to_minutes(start), time_to_minutes(end)
+    candidates = list(in_memory or [])
+    candidates += [e for e in read_entries_for_day(user_id, date_str) if not (exclude_rid and e["rid"] == exclude_rid)]
+    conflicts = [
+        (e["start"], e["end"]) for e in candidates
+        if e.get("start") and e.get("end") and _minutes_overlap(s, e_, time_to_minutes(e["start"]), time_to_minutes(e["end"]))
+    ]
     return (len(conflicts) > 0, conflicts)
 
 def compute_daily_minutes(entries: List[Dict[str, str]]) -> int:
@@ -369,16 +655,27 @@ async def sticky_set(update_or_ctx, context: ContextTypes.DEFAULT_TYPE, text: st
     chat_id = chat.id if chat else update_or_ctx.callback_query.message.chat.id
     sticky_id = context.user_data.get("sticky_id")
     if sticky_id:
+        # panel wygląda tak samo jak ostatnio – pomijamy wywołanie API
+        last = context.user_data.get("_last_render")
+        if last == (sticky_id, text, reply_markup):
+            return
         try:
-            await context.bot.edit_message_text(chat_id=chat_id, message_id=sticky_id, text=text, reply_markup=reply_markup)
+            if last and last[:2] == (sticky_id, text):
+                # zmieniła się tylko klawiatura (np. zaznaczenie godziny) – nie wysyłamy tekstu ponownie
+                await context.bot.edit_message_reply_markup(chat_id=chat_id, message_id=sticky_id, reply_markup=reply_markup)
+            else:
+                await context.bot.edit_message_text(chat_id=chat_id, message_id=sticky_id, text=text, reply_markup=reply_markup)
+            context.user_data["_last_render"] = (sticky_id, text, reply_markup)
             return
         except BadRequest as e:
             if "message is not modified" in str(e).lower():
+                context.user_data["_last_render"] = (sticky_id, text, reply_markup)
                 return
         except Exception:
             pass
     m = await context.bot.send_message(chat_id, text, reply_markup=reply_markup)
     context.user_data["sticky_id"] = m.message_id
+    context.user_data["_last_render"] = (m.message_id, text, reply_markup)
 
 async def sticky_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
     sticky_id = context.user_data.get("sticky_id")
@@ -388,6 +685,13 @@ async def sticky_delete(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
         except Exception:
             pass
         context.user_data.pop("sticky_id", None)
+        context.user_data.pop("_last_render", None)
+
+async def safe_delete(msg):
+    try:
+        await msg.delete()
+    except Exception:
+        pass
 
 async def safe_answer(q, text: Optional[str] = None, show_alert: bool = False):
     try:
@@ -419,26 +723,45 @@ def top_view(context):
     stack = context.user_data.get("view_stack") or []
     return stack[-1] if stack else None
 
+def ensure_view(context, name: str, replace: bool = False):
+    # widok już na wierzchu → nic nie zmieniamy; replace=True podmienia wierzch zamiast dokładać
+    top = top_view(context)
+    if top and top.name == name:
+        return
+    if replace:
+        pop_view(context)
+    push_view(context, name)
+
 # ──────────────────── Panel renderers ────────────────────
+_today_cache: Tuple[float, str] = (0.0, "")  # (północ następnego dnia jako timestamp, "dd.mm.YYYY")
+
 def today_str() -> str:
-    return datetime.now().strftime("%d.%m.%Y")
+    # wołane w prawie każdym handlerze – strftime tylko raz na dobę, do najbliższej północy zwracamy gotowy napis
+    global _today_cache
+    if time.time() >= _today_cache[0]:
+        d = date.today()
+        midnight = datetime.combine(d + timedelta(days=1), datetime.min.time()).timestamp()
+        _today_cache = (midnight, to_ddmmyyyy(d))
+    return _today_cache[1]
 
 def to_ddmmyyyy(d: date) -> str:
     return d.strftime("%d.%m.%Y")
 
-def format_home(uid: int, date_str: str, name: str) -> str:
+# jedna pozycja raportu w podglądzie; cały blok składany jednym join zamiast extend per wpis
+ENTRY_TMPL = "#{i} {sep} 📍 {place} {sep} ⏰ {start}-{end}\n📝 {tasks}\n💬 {notes}\n"
+
+def _entries_block(entries: List[Dict[str, str]], sep: str) -> str:
+    return "\n".join(
+        ENTRY_TMPL.format(i=i, sep=sep, place=e["place"], start=e["start"], end=e["end"],
+                          tasks=e["tasks"] or "-", notes=e["notes"] or "-")
+        for i, e in enumerate(entries, start=1)
+    )
+
+def format_home(date_str: str, name: str, entries: List[Dict[str, str]]) -> str:
     lines = [f"👤 {name} | 📅 {date_str}"]
-    exists = report_exists(uid, date_str)
-    if exists:
-        entries = read_entries_for_day(uid, date_str)
+    if entries:
         lines.append("\n📄 *Raport na dziś:*")
-        for i, e in enumerate(entries, start=1):
-            lines.extend([
-                f"#{i} • 📍 {e['place']} • ⏰ {e['start']}-{e['end']}",
-                f"📝 {e['tasks'] or '-'}",
-                f"💬 {e['notes'] or '-'}",
-                ""
-            ])
+        lines.append(_entries_block(entries, "•"))
         total = compute_daily_minutes(entries)
         if total:
             lines.append(f"⏳ Suma: {minutes_to_hhmm(total)}")
@@ -447,8 +770,12 @@ def format_home(uid: int, date_str: str, name: str) -> str:
     lines.append("\nWybierz czynność ⬇️")
     return "\n".join(lines)
 
-def build_main_menu(uid: int, date_str: str) -> InlineKeyboardMarkup:
-    exists = report_exists(uid, date_str)
+def build_main_menu(date_str: str, exists: bool) -> InlineKeyboardMarkup:
+    return _main_menu_kb(date_str, exists)
+
+# klawiatury zależą tylko od kilku prostych wartości – budujemy każdy wariant raz
+@lru_cache(maxsize=64)
+def _main_menu_kb(date_str: str, exists: bool) -> InlineKeyboardMarkup:
     if exists:
         kb = [
             [InlineKeyboardButton(f"📅 Data: {date_str}", callback_data="date:open")],
@@ -466,6 +793,11 @@ def build_main_menu(uid: int, date_str: str) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(kb)
 
 def month_kb(year: int, month: int) -> InlineKeyboardMarkup:
+    return _month_kb(year, month, today_str())
+
+@lru_cache(maxsize=64)
+def _month_kb(year: int, month: int, today: str) -> InlineKeyboardMarkup:
+    # "Dziś" zależy od daty – jest częścią klucza cache
     month_name = cal.month_name[month]
     days = cal.monthcalendar(year, month)
     rows = []
@@ -484,7 +816,7 @@ def month_kb(year: int, month: int) -> InlineKeyboardMarkup:
     next_month = (date(year, month, cal.monthrange(year, month)[1]) + timedelta(days=1))
     rows.append([
         InlineKeyboardButton("« Poprz", callback_data=f"cal:{prev_month.year}-{prev_month.month:02d}"),
-        InlineKeyboardButton("Dziś", callback_data=f"day:{today_str()}"),
+        InlineKeyboardButton("Dziś", callback_data=f"day:{today}"),
         InlineKeyboardButton("Nast »", callback_data=f"cal:{next_month.year}-{next_month.month:02d}"),
     ])
     rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:back")])
@@ -525,12 +857,19 @@ def panel_create_text(context: ContextTypes.DEFAULT_TYPE) -> str:
     lines.append("Wybierz czynność ⬇️")
     return "\n".join(lines)
 
-def kb_create(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-    back_label = "↩️ Do edycji" if context.user_data.get("from_edit") else "↩️ Wstecz"
-    back_cb = "nav:editlist" if context.user_data.get("from_edit") else "nav:home"
+def _await_field(context: ContextTypes.DEFAULT_TYPE, mode: str) -> Optional[str]:
     aw = context.user_data.get("await") or {}
-    t_lbl = "📝 Zadania (tekst)" + (" ●" if aw.get("field") == "tasks" and aw.get("mode") == "create" else "")
-    n_lbl = "💬 Uwagi (tekst)" + (" ●" if aw.get("field") == "notes" and aw.get("mode") == "create" else "")
+    return aw.get("field") if aw.get("mode") == mode else None
+
+def kb_create(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
+    return _kb_create(bool(context.user_data.get("from_edit")), _await_field(context, "create"))
+
+@lru_cache(maxsize=None)
+def _kb_create(from_edit: bool, active: Optional[str]) -> InlineKeyboardMarkup:
+    back_label = "↩️ Do edycji" if from_edit else "↩️ Wstecz"
+    back_cb = "nav:editlist" if from_edit else "nav:home"
+    t_lbl = "📝 Zadania (tekst)" + (" ●" if active == "tasks" else "")
+    n_lbl = "💬 Uwagi (tekst)" + (" ●" if active == "notes" else "")
     kb = [
         [InlineKeyboardButton("📍 Miejsce", callback_data="set:place"),
          InlineKeyboardButton("⏰ Start", callback_data="set:start"),
@@ -544,36 +883,34 @@ def kb_create(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(kb)
 
-def panel_edit_list_text(context: ContextTypes.DEFAULT_TYPE) -> str:
+def panel_edit_list_text(context: ContextTypes.DEFAULT_TYPE, entries: List[Dict[str, str]]) -> str:
     date_str = context.user_data.get("date", today_str())
-    uid = context.user_data.get("uid")
-    entries = read_entries_for_day(uid, date_str)
     context.user_data["edit_entries"] = entries
+    context.user_data["edit_entries_by_rid"] = {e["rid"]: e for e in entries}
     lines = [f"✏️ Panel: *Edycja raportu* — {date_str}\n"]
     if not entries:
         lines.append("Brak wpisów dla tej daty.")
     else:
-        for i, e in enumerate(entries, start=1):
-            lines.extend([
-                f"#{i} | 📍 {e['place']} | ⏰ {e['start']}-{e['end']}",
-                f"📝 {e['tasks'] or '-'}",
-                f"💬 {e['notes'] or '-'}",
-                ""
-            ])
+        lines.append(_entries_block(entries, "|"))
         total = compute_daily_minutes(entries)
         if total:
             lines.append(f"⏳ Suma: {minutes_to_hhmm(total)}")
     lines.append("\nWybierz pozycję do edycji lub dodaj nową.")
     return "\n".join(lines)
 
+# stałe wiersze pod listą wpisów – budowane raz, dynamiczne są tylko pozycje
+_EDIT_LIST_TAIL = (
+    (InlineKeyboardButton("➕ Dodaj nową pozycję", callback_data="editlist:addnew"),),
+    (InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home"),),
+)
+
 def kb_edit_list(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     entries = context.user_data.get("edit_entries", [])
-    rows = []
-    for idx, e in enumerate(entries, start=1):
-        label = f"#{idx} {e['place']} {e['start']}-{e['end']}"
-        rows.append([InlineKeyboardButton(label, callback_data=f"entry:{idx-1}")])
-    rows.append([InlineKeyboardButton("➕ Dodaj nową pozycję", callback_data="editlist:addnew")])
-    rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")])
+    rows = [
+        (InlineKeyboardButton(f"#{idx} {e['place']} {e['start']}-{e['end']}", callback_data=f"entry:{idx-1}"),)
+        for idx, e in enumerate(entries, start=1)
+    ]
+    rows.extend(_EDIT_LIST_TAIL)
     return InlineKeyboardMarkup(rows)
 
 def panel_edit_entry_text(context: ContextTypes.DEFAULT_TYPE) -> str:
@@ -598,9 +935,12 @@ def panel_edit_entry_text(context: ContextTypes.DEFAULT_TYPE) -> str:
     return "\n".join(lines)
 
 def kb_edit_entry(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
-    aw = context.user_data.get("await") or {}
-    t_lbl = "📝 Zadania" + (" ●" if aw.get("field") == "tasks" and aw.get("mode") == "edit" else "")
-    n_lbl = "💬 Uwagi" + (" ●" if aw.get("field") == "notes" and aw.get("mode") == "edit" else "")
+    return _kb_edit_entry(_await_field(context, "edit"))
+
+@lru_cache(maxsize=None)
+def _kb_edit_entry(active: Optional[str]) -> InlineKeyboardMarkup:
+    t_lbl = "📝 Zadania" + (" ●" if active == "tasks" else "")
+    n_lbl = "💬 Uwagi" + (" ●" if active == "notes" else "")
     kb = [
         [InlineKeyboardButton("📍 Miejsce", callback_data="editf:place")],
         [InlineKeyboardButton("⏰ Start", callback_data="editf:start"),
@@ -611,9 +951,26 @@ def kb_edit_entry(context: ContextTypes.DEFAULT_TYPE) -> InlineKeyboardMarkup:
     ]
     return InlineKeyboardMarkup(kb)
 
+# stałe klawiatury – budowane raz przy imporcie
+OVERLAP_KB = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Kontynuuj mimo to", callback_data="ovl:ok")],
+    [InlineKeyboardButton("Zmień godziny", callback_data="ovl:fix")],
+    [InlineKeyboardButton("↩️ Wstecz", callback_data="nav:create")],
+])
+BACK_HOME_KB = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")]])
+BACK_EDITLIST_KB = InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wstecz", callback_data="nav:editlist")]])
+
+def _time_sel_str(sel: dict) -> str:
+    hh = "--" if sel.get("h") is None else f"{sel['h']:02d}"
+    mm = "--" if sel.get("m") is None else f"{sel['m']:02d}"
+    return f"{hh}:{mm}"
+
 def time_kb(selection: dict, back_to: str) -> InlineKeyboardMarkup:
-    h = selection.get("h")
-    m = selection.get("m")
+    return _time_kb(selection.get("h"), selection.get("m"), back_to)
+
+@lru_cache(maxsize=None)
+def _time_kb(h: Optional[int], m: Optional[int], back_to: str) -> InlineKeyboardMarkup:
+    # skończona liczba stanów (25 × 5 × 2) – każda klawiatura budowana tylko raz
     rows = []
     for base in [0, 6, 12, 18]:
         row = []
@@ -626,13 +983,14 @@ def time_kb(selection: dict, back_to: str) -> InlineKeyboardMarkup:
         mark = "●" if m == mm else "○"
         rowm.append(InlineKeyboardButton(f"{mark} {mm:02d}", callback_data=f"t:m:{mm:02d}"))
     rows.append(rowm)
-    rows.append([InlineKeyboardButton("✅ OK", callback_data="t:ok"),
+    sel = _time_sel_str({"h": h, "m": m})
+    rows.append([InlineKeyboardButton(f"✅ OK ({sel})", callback_data="t:ok"),
                  InlineKeyboardButton("❌ Anuluj", callback_data="t:cancel")])
     rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data=f"nav:{back_to}")])
     return InlineKeyboardMarkup(rows)
 
 # ──────────────────── centralny renderer ────────────────────
-async def render(update_or_ctx, context: ContextTypes.DEFAULT_TYPE):
+async def render(update_or_ctx, context: ContextTypes.DEFAULT_TYPE, day_entries: Optional[List[Dict[str, str]]] = None):
     v = top_view(context)
     uid = (update_or_ctx.effective_user.id if isinstance(update_or_ctx, Update)
            else update_or_ctx.callback_query.from_user.id)
@@ -640,7 +998,10 @@ async def render(update_or_ctx, context: ContextTypes.DEFAULT_TYPE):
     ds = context.user_data.get("date", today_str())
 
     if not v or v.name == "home":
-        await sticky_set(update_or_ctx, context, format_home(uid, ds, name), build_main_menu(uid, ds))
+        # jeden odczyt dnia wystarcza i na podgląd, i na wybór "Twórz"/"Edytuj";
+        # day_entries – wpisy dnia, które wołający już ma (np. prosto z save_report)
+        entries = day_entries if day_entries is not None else await asyncio.to_thread(read_entries_for_day, uid, ds)
+        await sticky_set(update_or_ctx, context, format_home(ds, name, entries), build_main_menu(ds, bool(entries)))
         return
 
     if v.name == "calendar":
@@ -653,7 +1014,8 @@ async def render(update_or_ctx, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if v.name == "edit_list":
-        await sticky_set(update_or_ctx, context, panel_edit_list_text(context), kb_edit_list(context))
+        entries = await asyncio.to_thread(read_entries_for_day, context.user_data.get("uid"), ds)
+        await sticky_set(update_or_ctx, context, panel_edit_list_text(context, entries), kb_edit_list(context))
         return
 
     if v.name == "edit_entry":
@@ -662,35 +1024,37 @@ async def render(update_or_ctx, context: ContextTypes.DEFAULT_TYPE):
 
     if v.name == "place_select_create":
         uid = context.user_data.get("uid")
-        await sticky_set(update_or_ctx, context, "📍 Wybierz miejsce:", kb_place_select("create", uid))
+        await sticky_set(update_or_ctx, context, "📍 Wybierz miejsce:", await kb_place_select("create", uid))
         return
 
     if v.name == "place_select_edit":
         uid = context.user_data.get("uid")
-        await sticky_set(update_or_ctx, context, "📍 Wybierz nowe miejsce:", kb_place_select("edit", uid))
+        await sticky_set(update_or_ctx, context, "📍 Wybierz nowe miejsce:", await kb_place_select("edit", uid))
         return
 
     if v.name == "time_pick":
         sel = context.user_data.get("time_edit", {"h": None, "m": 0})
-        hh = "--" if sel.get("h") is None else f"{sel['h']:02d}"
-        mm = "--" if sel.get("m") is None else f"{sel['m']:02d}"
-        title = f"⏰ Ustaw czas (HH:MM)\nWybrane: {hh}:{mm}"
+        title = "⏰ Ustaw czas (HH:MM)"  # stały – wybór widać na klawiaturze
         back_to = "create" if sel.get("mode") == "create" else "editentry"
         await sticky_set(update_or_ctx, context, title, time_kb(sel, back_to=back_to))
         return
 
-def kb_place_select(context_kind: str, uid: int) -> InlineKeyboardMarkup:
-    def _rows(user_places: List[str]) -> List[List[InlineKeyboardButton]]:
-        rows = []
-        for i, p in enumerate(user_places):
-            rows.append([InlineKeyboardButton(p, callback_data=f"place_preset:{i}")])
-        rows.append([InlineKeyboardButton("✍️ Wpisz ręcznie (wyślij tekst)", callback_data="place_manual")])
-        if context_kind == "create":
-            rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:create")])
-        else:
-            rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:editentry")])
-        return rows
-    return InlineKeyboardMarkup(_rows(get_recent_places(uid)))
+async def kb_place_select(context_kind: str, uid: int) -> InlineKeyboardMarkup:
+    # odczyt presetów (przy zmianie pliku) poza pętlą zdarzeń
+    places = await asyncio.to_thread(get_recent_places, uid)
+    return _kb_place_select(context_kind, tuple(places))
+
+@lru_cache(maxsize=256)
+def _kb_place_select(context_kind: str, user_places: Tuple[str, ...]) -> InlineKeyboardMarkup:
+    rows = []
+    for i, p in enumerate(user_places):
+        rows.append([InlineKeyboardButton(p, callback_data=f"place_preset:{i}")])
+    rows.append([InlineKeyboardButton("✍️ Wpisz ręcznie (wyślij tekst)", callback_data="place_manual")])
+    if context_kind == "create":
+        rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:create")])
+    else:
+        rows.append([InlineKeyboardButton("↩️ Wstecz", callback_data="nav:editentry")])
+    return InlineKeyboardMarkup(rows)
 
 # ──────────────────── top-level handlers ────────────────────
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -716,7 +1080,7 @@ async def main_menu_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await render(update, context)
         return
     if q.data == "panel:create":
-        if report_exists(uid, ds):
+        if await asyncio.to_thread(report_exists, uid, ds):
             await safe_answer(q, text="Raport dla tej daty już istnieje. Przechodzę do edycji.", show_alert=False)
             push_view(context, "edit_list")
             await render(update, context)
@@ -735,13 +1099,13 @@ async def calendar_nav_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(q)
     data = q.data
     if data.startswith("cal:"):
-        y, m = map(int, data.split(":")[1].split("-"))
+        y, m = map(int, data.partition(":")[2].split("-"))
         pop_view(context)
         push_view(context, "calendar", year=y, month=m)
         await render(update, context)
         return DATE_PICK
     elif data.startswith("day:"):
-        ds = data.split(":")[1]
+        ds = data.partition(":")[2]
         context.user_data["date"] = ds
         # po wyborze daty wracamy do home (z przeglądem raportu dla tej daty)
         context.user_data["view_stack"] = [View("home", {})]
@@ -752,7 +1116,8 @@ async def calendar_nav_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def nav_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     await safe_answer(q)
-    action = q.data.split(":")[1]
+    action = q.data.partition(":")[2]
+    leaving_edit = top_view(context) is not None and top_view(context).name in ("edit_list", "edit_entry")
     if action == "home":
         context.user_data["view_stack"] = [View("home", {})]
     elif action == "back":
@@ -760,15 +1125,28 @@ async def nav_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if not top_view(context):
             context.user_data["view_stack"] = [View("home", {})]
     elif action == "create":
-        push_view(context, "create")
+        ensure_view(context, "create")
     elif action == "editentry":
-        push_view(context, "edit_entry")
+        ensure_view(context, "edit_entry")
     elif action == "editlist":
-        push_view(context, "edit_list")
+        ensure_view(context, "edit_list")
     await render(update, context)
+    # wyjście z edycji kończy serię zmian – zapis xlsx od razu, bez czekania na FLUSH_DELAY
+    if leaving_edit and top_view(context).name == "home":
+        context.application.create_task(asyncio.to_thread(flush_now))
 
 # ──────────────────── EXPORT ────────────────────
 async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # uprawnienia najpierw – odmowa nie kosztuje parsowania miesiąca ani dodatkowego wywołania API
+    if ADMIN_IDS and update.effective_user.id not in ADMIN_IDS:
+        msg = "Brak uprawnień do eksportu (tylko admini). Użyj /myexport <YYYY-MM>."
+        if update.callback_query:
+            # i tak musimy odpowiedzieć na query – odmowa jedzie w tej samej odpowiedzi
+            await safe_answer(update.callback_query, text=msg, show_alert=True)
+        else:
+            await sticky_set(update, context, msg)
+        return ConversationHandler.END
+
     if update.callback_query:
         await safe_answer(update.callback_query)
     month_arg = None
@@ -778,22 +1156,17 @@ async def export_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         args = getattr(context, "args", []) or []
         month_arg = args[0] if args else month_key_from_date(today_str())
 
-    if ADMIN_IDS and update.effective_user.id not in ADMIN_IDS:
-        await sticky_set(update, context, "Brak uprawnień do eksportu (tylko admini). Użyj /myexport <YYYY-MM>.")
-        return ConversationHandler.END
-
-    path = export_month(month_arg)
-    if not path:
+    res = await asyncio.to_thread(export_month, month_arg)
+    if not res:
         await sticky_set(update, context, f"Brak danych dla {month_arg}.")
         return ConversationHandler.END
 
-    with open(path, "rb") as f:
-        await update.effective_chat.send_document(f, filename=os.path.basename(path), caption=f"Eksport {month_arg}")
-    try:
-        os.remove(path)
-    except Exception:
-        pass
-    await render(update, context)
+    buf, fname = res
+    # wysyłka pliku i odświeżenie panelu są niezależne – równolegle
+    await asyncio.gather(
+        update.effective_chat.send_document(buf, filename=fname, caption=f"Eksport {month_arg}"),
+        render(update, context),
+    )
     return ConversationHandler.END
 
 async def myexport_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -807,42 +1180,48 @@ async def myexport_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         args = getattr(context, "args", []) or []
         month_arg = args[0] if args else month_key_from_date(today_str())
 
-    path = export_month(month_arg, user_id=update.effective_user.id)
-    if not path:
+    res = await asyncio.to_thread(export_month, month_arg, update.effective_user.id)
+    if not res:
         await sticky_set(update, context, f"Brak danych dla {month_arg}.")
         return ConversationHandler.END
 
-    with open(path, "rb") as f:
-        await update.effective_chat.send_document(f, filename=os.path.basename(path), caption=f"Mój eksport {month_arg}")
-    try:
-        os.remove(path)
-    except Exception:
-        pass
-    await render(update, context)
+    buf, fname = res
+    await asyncio.gather(
+        update.effective_chat.send_document(buf, filename=fname, caption=f"Mój eksport {month_arg}"),
+        render(update, context),
+    )
     return ConversationHandler.END
 
-def export_month(month_key: str, user_id: Optional[int] = None) -> Optional[str]:
-    if not os.path.exists(EXCEL_FILE):
-        return None
-    def _exp() -> Optional[str]:
-        wb = load_workbook(EXCEL_FILE)
-        if month_key not in wb.sheetnames:
+def export_month(month_key: str, user_id: Optional[int] = None) -> Optional[Tuple[BytesIO, str]]:
+    def _rows() -> Optional[List[tuple]]:
+        ws = get_month_sheet_if_exists(_get_wb(), month_key)
+        if ws is None:
             return None
-        ws = wb[month_key]
-        out = Workbook()
-        wso = out.active
-        wso.title = month_key
+        if user_id:
+            return [_row_values(ws, r) for r in _row_index(ws).by_user.get(str(user_id), [])]
+        return [row for row in ws.iter_rows(min_row=2, max_col=len(HEADERS), values_only=True) if row[0]]
+    rows = _with_lock(_rows)
+    if rows is None:
+        return None
+    buf = BytesIO()
+    if xlsxwriter:
+        # constant_memory: wiersze zrzucane na bieżąco, kilkukrotnie szybciej niż openpyxl
+        out = xlsxwriter.Workbook(buf, {"constant_memory": True})
+        wso = out.add_worksheet(month_key)
+        wso.write_row(0, 0, HEADERS)
+        for r, row in enumerate(rows, start=1):
+            wso.write_row(r, 0, row)
+        out.close()
+    else:
+        # write-only: wiersze idą strumieniowo do pliku, bez drzewa komórek w pamięci
+        out = Workbook(write_only=True)
+        wso = out.create_sheet(title=month_key)
         wso.append(HEADERS)
-        for row in ws.iter_rows(min_row=2, values_only=True):
-            if not row or not row[0]:
-                continue
-            if user_id and not str(row[0]).startswith(f"{user_id}_"):
-                continue
-            wso.append(list(row))
-        tmpf = os.path.join(DATA_DIR, f"export_{month_key}_{user_id or 'ALL'}.xlsx")
-        _atomic_save_wb(out, tmpf)
-        return tmpf
-    return _with_lock(_exp)
+        for row in rows:
+            wso.append(row)
+        out.save(buf)
+    buf.seek(0)
+    return buf, f"export_{month_key}_{user_id or 'ALL'}.xlsx"
 
 # ──────────────────── PANEL: tworzenie wpisów ────────────────────
 async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -852,7 +1231,7 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # set:field
     if data.startswith("set:"):
-        field = data.split(":")[1]
+        field = data.partition(":")[2]
         if field == "place":
             push_view(context, "place_select_create")
             await render(update, context)
@@ -863,7 +1242,7 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             init_m = 0
             if cur.get(field):
                 try:
-                    hh, mm = cur[field].split(":")
+                    hh, _, mm = cur[field].partition(":")
                     init_h, init_m = int(hh), int(mm)
                 except Exception:
                     init_h, init_m = None, 0
@@ -880,13 +1259,12 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
     # wybór miejsca (preset/manual)
     if data.startswith("place_preset:"):
-        idx = int(data.split(":")[1])
-        places = get_recent_places(context.user_data.get("uid"))
+        idx = int(data.partition(":")[2])
+        places = await asyncio.to_thread(get_recent_places, context.user_data.get("uid"))
         if idx < len(places):
             context.user_data.setdefault("current_entry", {})["place"] = places[idx]
             await safe_answer(q, text=f"Wybrano: {places[idx]}")
-        pop_view(context)
-        push_view(context, "create")
+        ensure_view(context, "create", replace=True)
         await render(update, context)
         return
 
@@ -915,20 +1293,15 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             return
         uid = context.user_data.get("uid")
         date_str = context.user_data.get("date", today_str())
-        overlap, conflicts = has_overlap(uid, date_str, cur["start"], cur["end"], in_memory=context.user_data.get("entries", []))
+        overlap, conflicts = await asyncio.to_thread(has_overlap, uid, date_str, cur["start"], cur["end"], in_memory=context.user_data.get("entries", []))
         if overlap:
             context.user_data["pending_overlap"] = {"cur": cur, "conflicts": conflicts}
-            kb = InlineKeyboardMarkup([
-                [InlineKeyboardButton("Kontynuuj mimo to", callback_data="ovl:ok")],
-                [InlineKeyboardButton("Zmień godziny", callback_data="ovl:fix")],
-                [InlineKeyboardButton("↩️ Wstecz", callback_data="nav:create")],
-            ])
             msg = "⚠️ Nakładanie z przedziałami: " + ", ".join([f"{a}-{b}" for a,b in conflicts])
-            await sticky_set(update, context, msg, kb)
+            await sticky_set(update, context, msg, OVERLAP_KB)
             return OVERLAP_DECIDE
 
         context.user_data.setdefault("entries", []).append(cur)
-        remember_place(uid, cur["place"])
+        await asyncio.to_thread(remember_place, uid, cur["place"])
         context.user_data["current_entry"] = {}
         context.user_data.pop("await", None)
         await safe_answer(q, text="Dodano pozycję.")
@@ -936,12 +1309,12 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         return
 
     if data.startswith("ovl:"):
-        action = data.split(":")[1]
+        action = data.partition(":")[2]
         if action == "ok":
             cur = context.user_data.get("pending_overlap", {}).get("cur")
             if cur:
                 context.user_data.setdefault("entries", []).append(cur)
-                remember_place(context.user_data.get("uid"), cur["place"])
+                await asyncio.to_thread(remember_place, context.user_data.get("uid"), cur["place"])
                 context.user_data["current_entry"] = {}
             context.user_data.pop("pending_overlap", None)
             context.user_data.pop("await", None)
@@ -963,12 +1336,12 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 return
             uid = context.user_data.get("uid")
             date_str = context.user_data.get("date", today_str())
-            overlap, conflicts = has_overlap(uid, date_str, cur["start"], cur["end"], in_memory=context.user_data.get("entries", []))
+            overlap, conflicts = await asyncio.to_thread(has_overlap, uid, date_str, cur["start"], cur["end"], in_memory=context.user_data.get("entries", []))
             if overlap:
                 await safe_answer(q, text="Bieżąca pozycja nakłada się czasowo – popraw godziny.", show_alert=True)
                 return
             context.user_data.setdefault("entries", []).append(cur)
-            remember_place(uid, cur["place"])
+            await asyncio.to_thread(remember_place, uid, cur["place"])
             context.user_data["current_entry"] = {}
 
         entries = context.user_data.get("entries", [])
@@ -977,13 +1350,13 @@ async def panel_create_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             return
 
         # Zapis do Excela
-        save_report(entries, context.user_data.get("uid"), context.user_data.get("date", today_str()), context.user_data.get("name"))
+        saved = await asyncio.to_thread(save_report, entries, context.user_data.get("uid"), context.user_data.get("date", today_str()), context.user_data.get("name"))
         context.user_data["entries"] = []
         context.user_data.pop("await", None)
         await safe_answer(q, text="Zapisano raport do Excela.")
         # wróć do ekranu głównego z podglądem raportu
         context.user_data["view_stack"] = [View("home", {})]
-        await render(update, context)
+        await render(update, context, day_entries=saved)
         return
 
 # ──────────────────── PANEL: edycja wpisów ────────────────────
@@ -992,7 +1365,7 @@ async def edit_list_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await safe_answer(q)
     data = q.data
     if data.startswith("entry:"):
-        idx = int(data.split(":")[1])
+        idx = int(data.partition(":")[2])
         context.user_data["edit_idx"] = idx
         push_view(context, "edit_entry")
         await render(update, context)
@@ -1015,7 +1388,7 @@ async def edit_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
     e = entries[idx]
     if data.startswith("editf:"):
-        field = data.split(":")[1]
+        field = data.partition(":")[2]
         if field == "place":
             push_view(context, "place_select_edit")
             await render(update, context)
@@ -1026,7 +1399,7 @@ async def edit_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             try:
                 base = e[field]
                 if base:
-                    hh, mm = base.split(":")
+                    hh, _, mm = base.partition(":")
                     init_h, init_m = int(hh), int(mm)
             except Exception:
                 pass
@@ -1043,28 +1416,23 @@ async def edit_entry_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ──────────────────── TIME PICKER (create+edit) ────────────────────
 async def time_pick_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
-    await safe_answer(q)
     data = q.data
     sel = context.user_data.get("time_edit", {"h": None, "m": 0})
-    if data.startswith("t:h:"):
-        h = int(data.split(":")[2])
-        sel["h"] = h
+    # tapnięcia HH/MM: tytuł panelu się nie zmienia, więc render podmienia tylko klawiaturę
+    # (edit_message_reply_markup w sticky_set), równolegle z krótkim toastem
+    if data.startswith(("t:h:", "t:m:")):
+        sel["h" if data[2] == "h" else "m"] = int(data.rpartition(":")[2])
         context.user_data["time_edit"] = sel
-        await render(update, context)
-        return
-    if data.startswith("t:m:"):
-        m = int(data.split(":")[2])
-        sel["m"] = m
-        context.user_data["time_edit"] = sel
-        await render(update, context)
+        await asyncio.gather(safe_answer(q, text=f"⏰ {_time_sel_str(sel)}"), render(update, context))
         return
+    # na callback odpowiadamy raz, w gałęzi – inaczej późniejsze alerty (show_alert) by przepadały
     if data == "t:cancel":
         pop_view(context)
         if sel.get("mode") == "create":
             push_view(context, "create")
         else:
             push_view(context, "edit_entry")
-        await render(update, context)
+        await asyncio.gather(safe_answer(q), render(update, context))
         return
     if data == "t:ok":
         if sel.get("h") is None or sel.get("m") is None:
@@ -1078,20 +1446,25 @@ async def time_pick_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             cur[field] = tval
             if cur.get("start") and cur.get("end") and cur["start"] >= cur["end"]:
                 cur[field] = None
-                await safe_answer(q, text="Start musi być < koniec.", show_alert=True)
-            pop_view(context)
-            push_view(context, "create")
-            await render(update, context)
+                ack = safe_answer(q, text="Start musi być < koniec.", show_alert=True)
+            else:
+                ack = safe_answer(q)
+            ensure_view(context, "create", replace=True)
+            await asyncio.gather(ack, render(update, context))
             return
         else:
             rid = sel.get("rid")
             uid = context.user_data.get("uid")
             date_str = context.user_data.get("date", today_str())
-            entries = read_entries_for_day(uid, date_str)
-            tgt = next((x for x in entries if x["rid"] == rid), None)
+            # edit_entries wypełnia panel listy edycji – czytamy z Excela tylko gdy go brak
+            ebr = context.user_data.get("edit_entries_by_rid")
+            if not ebr:
+                entries = await asyncio.to_thread(read_entries_for_day, uid, date_str)
+                ebr = {x["rid"]: x for x in entries}
+            tgt = ebr.get(rid)
             if not tgt:
                 await safe_answer(q, text="Pozycja nie istnieje.", show_alert=True)
-                pop_view(context); push_view(context, "edit_list")
+                ensure_view(context, "edit_list", replace=True)
                 await render(update, context)
                 return
             new_start = tval if field == "start" else str(tgt["start"]) or tval
@@ -1099,31 +1472,34 @@ async def time_pick_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             if new_start and new_end and new_start >= new_end:
                 await safe_answer(q, text="Start musi być < koniec.", show_alert=True)
                 return
-            overlap, conflicts = has_overlap(uid, date_str, new_start, new_end, exclude_rid=rid)
+            overlap, conflicts = await asyncio.to_thread(has_overlap, uid, date_str, new_start, new_end, exclude_rid=rid)
             if overlap:
                 await safe_answer(q, text="Godziny nakładają się z innymi wpisami.", show_alert=True)
                 return
             try:
-                update_report_field(uid, date_str, rid, field, tval)
+                await asyncio.to_thread(update_report_field, uid, date_str, rid, field, tval)
+                context.user_data.pop("edit_entries", None)
+                context.user_data.pop("edit_entries_by_rid", None)
+                ack = safe_answer(q, text="✅ Zmieniono.")
             except Exception as ex:
-                await safe_answer(q, text=f"Błąd zapisu: {ex}", show_alert=True)
-            pop_view(context); push_view(context, "edit_list")
-            await render(update, context)
+                ack = safe_answer(q, text=f"Błąd zapisu: {ex}", show_alert=True)
+            ensure_view(context, "edit_list", replace=True)
+            # potwierdzenie i nowy panel idą równolegle – jedno opóźnienie zamiast dwóch
+            await asyncio.gather(ack, render(update, context))
             return
+    await safe_answer(q)
 
 # ──────────────────── AWAIT TEXT (create+edit) ────────────────────
 async def await_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    txt = (update.message.text or "").strip()
-    try:
-        await update.message.delete()
-    except Exception:
-        pass
-
+    # tekst bez aktywnego pola (●) nas nie dotyczy – nie kasujemy go i nie odświeżamy panelu
     info = context.user_data.get("await") or {}
     if not info:
-        await render(update, context)
         return
 
+    txt = (update.message.text or "").strip()
+    # kasowanie wiadomości i odświeżenie panelu są niezależne – lecą równolegle (gather niżej)
+    del_task = asyncio.create_task(safe_delete(update.message))
+
     mode = info.get("mode")
     field = info.get("field")
 
@@ -1131,11 +1507,10 @@ async def await_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         cur = context.user_data.setdefault("current_entry", {})
         cur[field] = txt
         if field == "place" and txt:
-            remember_place(context.user_data.get("uid"), txt)
+            await asyncio.to_thread(remember_place, context.user_data.get("uid"), txt)
         context.user_data.pop("await", None)
-        if not top_view(context) or top_view(context).name != "create":
-            push_view(context, "create")
-        await render(update, context)
+        ensure_view(context, "create")
+        await asyncio.gather(del_task, render(update, context))
         return
 
     if mode == "edit":
@@ -1143,17 +1518,23 @@ async def await_text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         uid = context.user_data.get("uid")
         date_str = context.user_data.get("date", today_str())
         try:
-            update_report_field(uid, date_str, rid, field, txt)
+            await asyncio.to_thread(update_report_field, uid, date_str, rid, field, txt)
+            context.user_data.pop("edit_entries", None)
+            context.user_data.pop("edit_entries_by_rid", None)
         except Exception as ex:
-            await sticky_set(update, context, f"❌ Błąd zapisu: {ex}", InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wstecz", callback_data="nav:editlist")]]))
             context.user_data.pop("await", None)
+            await asyncio.gather(
+                del_task,
+                sticky_set(update, context, f"❌ Błąd zapisu: {ex}", BACK_EDITLIST_KB),
+            )
             return
         context.user_data.pop("await", None)
-        if not top_view(context) or top_view(context).name != "edit_list":
-            push_view(context, "edit_list")
-        await render(update, context)
+        ensure_view(context, "edit_list")
+        await asyncio.gather(del_task, render(update, context))
         return
 
+    await del_task
+
 # ──────────────────── Komendy pomocnicze ────────────────────
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1164,15 +1545,16 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data.clear()
     return ConversationHandler.END
 
+HELP_TEXT = (
+    "📘 *Pomoc*\n"
+    "• /start – panel główny (z podglądem raportu, jeśli istnieje).\n"
+    "• Wprowadzanie tekstów (Miejsce/Zadania/Uwagi): wciśnij przycisk – obok pojawi się kropka (●) – wyślij wiadomość.\n"
+    "• Czas ustawiasz przyciskami HH/MM (00 min domyślnie, w edycji pre-selekcja).\n"
+    "• Eksport: przyciski lub /export, /myexport.\n"
+)
+
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    text = (
-        "📘 *Pomoc*\n"
-        "• /start – panel główny (z podglądem raportu, jeśli istnieje).\n"
-        "• Wprowadzanie tekstów (Miejsce/Zadania/Uwagi): wciśnij przycisk – obok pojawi się kropka (●) – wyślij wiadomość.\n"
-        "• Czas ustawiasz przyciskami HH/MM (00 min domyślnie, w edycji pre-selekcja).\n"
-        "• Eksport: przyciski lub /export, /myexport.\n"
-    )
-    await sticky_set(update, context, text, InlineKeyboardMarkup([[InlineKeyboardButton("↩️ Wstecz", callback_data="nav:home")]]))
+    await sticky_set(update, context, HELP_TEXT, BACK_HOME_KB)
 
 # ──────────────────── error handler ────────────────────
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1181,7 +1563,90 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     logging.exception("Unhandled exception: %s", err)
 
+# ──────────────────── routing callbacków ────────────────────
+# prefiks callback_data (do pierwszego ":") → handler; jeden lookup zamiast dopasowań regexów
+CALLBACK_ROUTES = {
+    # top-level menu actions
+    "date": main_menu_cb,
+    "panel": main_menu_cb,
+    "cal": calendar_nav_cb,
+    "day": calendar_nav_cb,
+    "nav": nav_handler,
+    # eksporty
+    "export": export_handler,
+    "myexport": myexport_handler,
+    # panel: create
+    "set": panel_create_handler,
+    "create": panel_create_handler,
+    "place_preset": panel_create_handler,
+    "place_manual": panel_create_handler,
+    "ovl": panel_create_handler,
+    # panel: edit list / entry
+    "entry": edit_list_handler,
+    "editlist": edit_list_handler,
+    "editf": edit_entry_handler,
+    # time picker
+    "t": time_pick_handler,
+}
+
+async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    handler = CALLBACK_ROUTES.get(update.callback_query.data.partition(":")[0])
+    if handler:
+        return await handler(update, context)
+
+# ──────────────────── sprzątanie user_data ────────────────────
+async def touch_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    # grupa -1: znacznik aktywności + minimalny stan, gdyby sweep wyczyścił user_data
+    user = update.effective_user
+    if not user:
+        return
+    context.user_data["_last_ts"] = time.time()
+    context.user_data.setdefault("uid", user.id)
+    context.user_data.setdefault("name", user.first_name)
+
+async def sweep_user_data(app: Application) -> None:
+    # co godzinę usuwamy stan paneli użytkowników nieaktywnych dłużej niż USER_STATE_TTL
+    while True:
+        await asyncio.sleep(3600)
+        now = time.time()
+        idle = [uid for uid, d in app.user_data.items() if d.setdefault("_last_ts", now) < now - USER_STATE_TTL]
+        for uid in idle:
+            app.drop_user_data(uid)
+        if idle:
+            logging.info("Wyczyszczono user_data %d nieaktywnych użytkowników", len(idle))
+
 # ──────────────────── PTB Application ────────────────────
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # różni użytkownicy obsługiwani równolegle, kolejne update'y jednego użytkownika – po kolei
+    # (stan panelu w user_data nie jest odporny na przeplot, np. podwójne "Zakończ")
+    # semafor klasy bazowej jest brany przed do_process_update – gdyby to on był limitem, update'y
+    # czekające w kolejce jednego użytkownika zajmowałyby miejsca wszystkich; dlatego bazie dajemy
+    # limit tylko nominalny, a właściwy (_slots) bierzemy dopiero po blokadzie użytkownika
+    _UNBOUNDED = 2 ** 16
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(self._UNBOUNDED)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+    async def do_process_update(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if not user:
+            async with self._slots:
+                await coroutine
+            return
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = self._locks[user.id] = asyncio.Lock()
+        async with lock, self._slots:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
 async def on_startup(app: Application) -> None:
     await app.bot.set_my_commands([
         BotCommand("start", "Otwórz panel raportów"),
@@ -1189,9 +1654,38 @@ async def on_startup(app: Application) -> None:
         BotCommand("myexport", "Mój eksport: /myexport YYYY-MM"),
         BotCommand("help", "Pomoc"),
     ])
+    app.bot_data["sweeper"] = asyncio.create_task(sweep_user_data(app))
+
+async def on_shutdown(app: Application) -> None:
+    sweeper = app.bot_data.pop("sweeper", None)
+    if sweeper:
+        sweeper.cancel()
+    await asyncio.to_thread(flush_now)
+    await asyncio.to_thread(upload_pending)
 
 def build_app() -> Application:
-    app = ApplicationBuilder().token(TELEGRAM_TOKEN).post_init(on_startup).build()
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .connection_pool_size(TG_POOL_SIZE)
+        .pool_timeout(30)
+        .connect_timeout(10)
+        .read_timeout(20)
+        .http_version(HTTP_VERSION)
+        # stan paneli zapisywany zbiorczo co 30 s – po restarcie edytujemy ten sam sticky zamiast wysyłać nowy
+        .persistence(PicklePersistence(
+            STATE_FILE,
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=30,
+        ))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+
+    # znacznik aktywności (przed wszystkimi handlerami)
+    app.add_handler(TypeHandler(Update, touch_user), group=-1)
 
     # komendy
     app.add_handler(CommandHandler("start", show_menu))
@@ -1199,26 +1693,10 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("myexport", myexport_handler))
     app.add_handler(CommandHandler("help", help_cmd))
 
-    # top-level menu actions
-    app.add_handler(CallbackQueryHandler(main_menu_cb, pattern=r"^(date:open|panel:(create|edit))$"))
-    app.add_handler(CallbackQueryHandler(calendar_nav_cb, pattern=r"^(cal:\d{4}-\d{2}|day:\d{2}\.\d{2}\.\d{4})$"))
-    app.add_handler(CallbackQueryHandler(nav_handler, pattern=r"^nav:(home|back|create|editentry|editlist)$"))
-
-    # eksporty – osobne callbacki
-    app.add_handler(CallbackQueryHandler(export_handler, pattern=r"^export$"))
-    app.add_handler(CallbackQueryHandler(myexport_handler, pattern=r"^myexport$"))
-
-    # panel: create
-    app.add_handler(CallbackQueryHandler(panel_create_handler, pattern=r"^(set:(place|start|end|tasks|notes)|create:(add|clear|finish)|place_preset:\d+|place_manual|ovl:(ok|fix))$"))
-
-    # panel: edit list / entry
-    app.add_handler(CallbackQueryHandler(edit_list_handler, pattern=r"^(entry:\d+|editlist:addnew)$"))
-    app.add_handler(CallbackQueryHandler(edit_entry_handler, pattern=r"^editf:(place|start|end|tasks|notes)$"))
-
-    # time picker
-    app.add_handler(CallbackQueryHandler(time_pick_handler, pattern=r"^(t:(h|m):\d{2}|t:(ok|cancel))$"))
+    # wszystkie callbacki – jeden handler, rozdział po prefiksie (CALLBACK_ROUTES)
+    app.add_handler(CallbackQueryHandler(callback_router))
 
-    # await text – kasujemy i odświeżamy panel
+    # await text – tylko gdy pole czeka na tekst: kasujemy wiadomość i odświeżamy panel
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, await_text_handler))
 
     # globalny error handler
@@ -1233,6 +1711,7 @@ if __name__ == "__main__":
     if not TELEGRAM_TOKEN:
         raise SystemExit("Brak TELEGRAM_TOKEN w env.")
 
+    replay_wal()  # dokończ zapisy przerwane przez awarię, zanim cokolwiek zostanie odczytane
     bot_app = build_app()
 
     if WEBHOOK_URL:
@@ -0,0 +1,162 @@
+import importlib
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from openpyxl import load_workbook
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+DAY = "15.10.2026"
+MONTH = "2026-10"
+
+
+class WalRecoveryTest(unittest.TestCase):
+    # każdy "start" bota to świeży import modułu nad tym samym DATA_DIR (jak nowy proces)
+
+    def setUp(self):
+        self.data_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.data_dir, ignore_errors=True)
+        self._env = {k: os.environ.get(k) for k in ("DATA_DIR", "FLUSH_DELAY")}
+        os.environ["DATA_DIR"] = self.data_dir
+        os.environ["FLUSH_DELAY"] = "3600"  # xlsx zapisujemy tylko jawnie (flush_now)
+        self.addCleanup(self._restore_env)
+        self.bot = self.start()
+
+    def _restore_env(self):
+        for k, v in self._env.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+        self.crash()
+
+    def start(self):
+        sys.modules.pop("raporty_bot", None)
+        return importlib.import_module("raporty_bot")
+
+    def crash(self):
+        # awaria: zaległy zapis xlsx przepada razem z procesem
+        bot = sys.modules.get("raporty_bot")
+        if bot and bot._flush_timer:
+            bot._flush_timer.cancel()
+
+    def restart(self):
+        self.crash()
+        self.bot = self.start()
+        return self.bot
+
+    def xlsx_ids(self):
+        if not os.path.exists(self.bot.EXCEL_FILE):
+            return []
+        wb = load_workbook(self.bot.EXCEL_FILE, read_only=True)
+        try:
+            if MONTH not in wb.sheetnames:
+                return []
+            return [r[0] for r in wb[MONTH].iter_rows(min_row=2, max_col=1, values_only=True) if r[0]]
+        finally:
+            wb.close()
+
+    def wal_size(self):
+        return os.path.getsize(self.bot.WAL_FILE) if os.path.exists(self.bot.WAL_FILE) else 0
+
+    def test_save_is_durable_before_flush(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00", "tasks": "t", "notes": ""}], 1, DAY, "Jan")
+        self.assertGreater(self.wal_size(), 0)
+        self.assertEqual(self.xlsx_ids(), [])
+
+        bot = self.restart()
+        entries = bot.read_entries_for_day(1, DAY)
+        self.assertEqual([(e["rid"], e["place"], e["tasks"]) for e in entries], [(f"1_{DAY}_1", "A", "t")])
+
+    def test_edit_after_restart_replays_in_order(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        self.bot.update_report_field(1, DAY, f"1_{DAY}_1", "notes", "po edycji")
+
+        bot = self.restart()
+        bot.replay_wal()
+        self.assertEqual(self.xlsx_ids(), [f"1_{DAY}_1"])
+        self.assertEqual(self.wal_size(), 0)
+        self.assertEqual(bot.read_entries_for_day(1, DAY)[0]["notes"], "po edycji")
+
+        # kolejny numer pozycji liczony także z odtworzonych wierszy
+        saved = bot.save_report([{"place": "B", "start": "10:00", "end": "11:00"}], 1, DAY, "Jan")
+        self.assertEqual([e["rid"] for e in saved], [f"1_{DAY}_1", f"1_{DAY}_2"])
+
+    def test_replay_is_idempotent_upsert_by_rid(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        self.bot.flush_now()
+        self.assertEqual(self.wal_size(), 0)
+
+        # WAL z wpisem, który jest już w xlsx (awaria między zapisem xlsx a obcięciem WAL)
+        rid = f"1_{DAY}_1"
+        self.bot._wal_append([
+            {"rid": rid, "date": DAY, "name": "Jan", "fields": {"place": "A", "start": "08:00", "end": "10:00", "tasks": "", "notes": ""}},
+            {"rid": rid, "date": DAY, "fields": {"notes": "po awarii"}},
+        ])
+        bot = self.restart()
+        bot.replay_wal()
+        bot = self.restart()
+        bot.replay_wal()
+
+        self.assertEqual(self.xlsx_ids(), [rid])
+        entries = bot.read_entries_for_day(1, DAY)
+        self.assertEqual([(e["place"], e["notes"]) for e in entries], [("A", "po awarii")])
+
+    def test_torn_tail_is_skipped(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        with open(self.bot.WAL_FILE, "ab") as f:
+            f.write(b'{"rid": "1_15.10')  # urwany zapis przy awarii
+
+        bot = self.restart()
+        bot.replay_wal()
+        self.assertEqual(self.xlsx_ids(), [f"1_{DAY}_1"])
+        self.assertEqual(self.wal_size(), 0)
+
+    def test_torn_only_wal_then_save_survives_crash(self):
+        # awaria w trakcie pierwszego dopisania po checkpoincie: w WAL tylko urwana linia
+        self.crash()
+        with open(self.bot.WAL_FILE, "wb") as f:
+            f.write(b'{"rid": "1_15.10')
+
+        bot = self.restart()
+        bot.replay_wal()
+        self.assertEqual(self.wal_size(), 0)
+
+        bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        bot = self.restart()
+        self.assertEqual([e["rid"] for e in bot.read_entries_for_day(1, DAY)], [f"1_{DAY}_1"])
+
+    def test_append_after_torn_line_starts_new_line(self):
+        # urwany zapis w działającym procesie (np. ENOSPC) – kolejny wpis nie może się z nim skleić
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        with open(self.bot.WAL_FILE, "ab") as f:
+            f.write(b'{"rid": "1_15.10')
+        self.bot.update_report_field(1, DAY, f"1_{DAY}_1", "notes", "po awarii")
+
+        bot = self.restart()
+        self.assertEqual(bot.read_entries_for_day(1, DAY)[0]["notes"], "po awarii")
+
+    def test_unknown_field_is_rejected_before_logging(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        size = self.wal_size()
+        with self.assertRaises(ValueError):
+            self.bot.update_report_field(1, DAY, f"1_{DAY}_1", "nope", "x")
+        self.assertEqual(self.wal_size(), size)
+
+    def test_replay_skips_record_that_cannot_be_applied(self):
+        self.bot.save_report([{"place": "A", "start": "08:00", "end": "10:00"}], 1, DAY, "Jan")
+        self.bot._wal_append([{"rid": f"1_{DAY}_1", "date": DAY, "fields": {"nope": "x"}}])
+
+        bot = self.restart()
+        bot.replay_wal()
+        self.assertEqual(self.wal_size(), 0)
+        self.assertEqual([e["place"] for e in bot.read_entries_for_day(1, DAY)], ["A"])
+
+
+if __name__ == "__main__":
+    unittest.main()